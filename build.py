@@ -1,21 +1,29 @@
 #!/usr/bin/env python
 
 import datetime as dt
+import gzip
+import hashlib
+import json
 import os
+import re
 import shutil
+import unicodedata
 
-from contextlib import contextmanager
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from html import escape, unescape
 from operator import attrgetter
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-import frontmatter
-import mistletoe
-import yattag
+import cmarkgfm
 
-from slugify import slugify
 from typogrify.filters import typogrify
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 BLOG_TITLE = "the blog"
 DEFAULT_DESCRIPTION = "A cool and nice programming blog"
 MY_NAME = "Patrick Gingras"
@@ -25,183 +33,663 @@ HEADER_LINKS = [
     ("github", "https://github.com/p7g"),
     ("linkedin", "https://linkedin.com/in/pat775"),
 ]
-
-
-def deferred_stylesheet(doc, href: str):
-    doc.stag(
-        "link",
-        rel="preload",
-        **{"as": "style"},
-        href=href,
-        onload="this.onload=null; this.rel='stylesheet';",
+CACHE_DIR = ".md-cache"
+MANIFEST_PATH = os.path.join("build", "manifest.json")
+WRITE_BUFFER_SIZE = 1 << 20
+READ_WORKERS = 8
+# every compressed copy that may be on disk, whether or not this run can
+# produce it; brotli copies are only written when the package is installed
+COMPRESSED_SUFFIXES = [".gz", ".br"]
+WRITTEN_COMPRESSED_SUFFIXES = [".gz", ".br"] if brotli is not None else [".gz"]
+# bump to invalidate cached post bodies when their rendering changes
+RENDER_CACHE_VERSION = "render_v2"
+# keep raw HTML (embeds, inline spans) and the <code class="language-..."> markup
+# mistletoe produced, so this is deliberately not the full GFM preset with its
+# tagfilter and <pre lang="...">. The pinned cmarkgfm bundles cmark 0.28, which
+# passes raw HTML through unless CMARK_OPT_SAFE is set; releases built on cmark
+# 0.29 and later need CMARK_OPT_UNSAFE here instead.
+MARKDOWN_OPTIONS = 0
+MARKDOWN_EXTENSIONS = ["table", "strikethrough"]
+
+QUOTE_RE = re.compile(r"'+")
+DIGIT_COMMA_RE = re.compile(r"(?<=\d),(?=\d)")
+# letters and punctuation that unidecode (used by python-slugify) spelled out
+# but that don't decompose to ASCII; curly apostrophes become straight ones,
+# which are then dropped rather than separating words, also like python-slugify
+TRANSLITERATIONS = str.maketrans(
+    {
+        "\u00df": "ss",
+        "\u00e6": "ae",
+        "\u00c6": "AE",
+        "\u0153": "oe",
+        "\u0152": "OE",
+        "\u00f8": "o",
+        "\u00d8": "O",
+        "\u0142": "l",
+        "\u0141": "L",
+        "\u0111": "d",
+        "\u0110": "D",
+        "\u00f0": "d",
+        "\u00d0": "D",
+        "\u00fe": "th",
+        "\u00de": "Th",
+        "\u0131": "i",
+        "\u2018": "'",
+        "\u2019": "'",
+    }
+)
+NON_SLUG_RE = re.compile(r"[^a-z0-9]+")
+FRONTMATTER_BOUNDARY_RE = re.compile(r"^-{3,}\s*$", re.MULTILINE)
+
+with open("styles.css", "r") as f:
+    STYLES_CSS = f.read()
+
+
+BASE_OPEN_TEMPLATE = (
+    "<!DOCTYPE html>"
+    '<html lang="{lang}">'
+    "<head>"
+    '<meta charset="utf-8" />'
+    '<meta name="viewport" content="width=device-width, initial-scale=1" />'
+    '<meta name="description" content="{description}" />'
+    '<link rel="shortcut icon" type="image/x-icon" href="/static/favicon.ico" />'
+    "<title>{title}</title>"
+)
+
+BASE_SHELL_TEMPLATE = "{stylesheets}<style>{styles}</style></head><body>"
+
+BASE_CLOSE = b"</body></html>"
+
+DEFERRED_STYLESHEET_TEMPLATE = (
+    '<link rel="preload" as="style" href="{href}"'
+    " onload=\"this.onload=null; this.rel='stylesheet';\" />"
+    '<noscript><link rel="stylesheet" href="{href}" /></noscript>'
+)
+
+HEADER_TEMPLATE = (
+    '<header class="header">'
+    '<a href="/" title="home"><h1 class="header__title">{title}</h1></a>'
+    '<p class="header__name">{name}</p>'
+    '<section class="header__links">{links}</section>'
+    "<hr />"
+    "</header>"
+)
+
+HEADER_LINK_TEMPLATE = '<a href="{href}" class="header__links__link">{text}</a> '
+
+HOME_OPEN = b'<main class="main"><section class="main__post_list">'
+
+HOME_CLOSE = b"</section></main>"
+
+POST_ITEM_TEMPLATE = (
+    '<article class="main__post">'
+    '<a href="{url}"><h3 class="main__post__title">{title}</h3></a>'
+    '<small class="main__post__date">'
+    '<time datetime="{date_iso}">{date_display}</time>'
+    "</small>"
+    "{description}"
+    "</article>"
+)
+
+POST_ITEM_DESCRIPTION_TEMPLATE = '<p class="main__post__description">{}</p>'
+
+POST_OPEN_TEMPLATE = (
+    '<main class="main">'
+    '<article class="post">'
+    '<header class="post__header">'
+    '<h2 class="post__heading">{title}</h2>'
+    '<time datetime="{date_iso}" class="post__heading__time">{date_display}</time>'
+    "</header>"
+    '<main class="post__main">'
+)
+
+# nothing in here varies between posts, so it's resolved once
+POST_CLOSE = (
+    "</main>"
+    "</article>"
+    "</main>"
+    '<footer class="post__footer">'
+    "<hr />"
+    "Tell me I'm wrong: "
+    '<a href="mailto:{email}" class="post__footer__email">{email}</a>'
+    "</footer>"
+).format(email=escape(EMAIL)).encode("utf-8")
+
+
+def deferred_stylesheet(href: str) -> str:
+    return DEFERRED_STYLESHEET_TEMPLATE.format(href=escape(href))
+
+
+def header() -> str:
+    return HEADER_TEMPLATE.format(
+        title=escape(BLOG_TITLE),
+        name=escape(MY_NAME),
+        links="".join(
+            HEADER_LINK_TEMPLATE.format(href=escape(address), text=escape(link_text))
+            for link_text, address in HEADER_LINKS
+        ),
     )
-    with doc.tag("noscript"):
-        doc.stag("link", rel="stylesheet", href=href)
-
 
-def header(doc, tag, text, line):
-    with tag("header", klass="header"):
-        with tag("a", href="/", title="home"):
-            line("h1", BLOG_TITLE, klass="header__title")
-        line("p", MY_NAME, klass="header__name")
 
-        with tag("section", klass="header__links"):
-            for link_text, address in HEADER_LINKS:
-                line("a", link_text, href=address, klass="header__links__link")
-                text(" ")
+# everything after the <title> up to the end of the page header is the same on
+# every page, so it's only rendered once
+BASE_SHELL = (
+    BASE_SHELL_TEMPLATE.format(
+        stylesheets=deferred_stylesheet(
+            "https://fonts.googleapis.com/css?family="
+            "IBM+Plex+Serif:400,400i,700,700i"
+            "|Faustina:400,400i,700,700i"
+            "|Inconsolata"
+            "&display=block"
+        ),
+        styles=STYLES_CSS,
+    )
+    + header()
+).encode("utf-8")
 
-        doc.stag("hr")
 
-    return doc
+def base_page_open(*, title: str = None, description: str = None) -> bytearray:
+    buf = bytearray(
+        BASE_OPEN_TEMPLATE.format(
+            lang=escape(LANG),
+            description=escape(description or DEFAULT_DESCRIPTION),
+            title=escape(f"{title} | {BLOG_TITLE}" if title else BLOG_TITLE),
+        ).encode("utf-8")
+    )
+    buf += BASE_SHELL
+    return buf
 
 
-@contextmanager
-def base_page(doc, tag, text, line, *, title: str = None, description: str = None):
-    doc.asis("<!DOCTYPE html>")
+def home_page(posts: List["Post"]) -> bytearray:
+    buf = base_page_open()
+    buf += HOME_OPEN
 
-    with tag("html", lang=LANG):
-        with tag("head"):
-            doc.stag("meta", charset="utf-8")
-            doc.stag(
-                "meta", name="viewport", content="width=device-width, initial-scale=1"
-            )
-            doc.stag(
-                "meta", name="description", content=description or DEFAULT_DESCRIPTION,
-            )
-            doc.stag(
-                "link",
-                rel="shortcut icon",
-                type="image/x-icon",
-                href="/static/favicon.ico",
-            )
-            line("title", f"{title} | {BLOG_TITLE}" if title else BLOG_TITLE)
-            deferred_stylesheet(
-                doc,
-                "https://fonts.googleapis.com/css?family="
-                "IBM+Plex+Serif:400,400i,700,700i"
-                "|Faustina:400,400i,700,700i"
-                "|Inconsolata"
-                "&display=block",
+    for post in posts:
+        description = ""
+        if post.description is not None:
+            description = POST_ITEM_DESCRIPTION_TEMPLATE.format(
+                post.description_html
             )
 
-            with open("styles.css", "r") as f:
-                line("style", f.read())
-        with tag("body"):
-            yield
-
-
-def home_page(posts: List["Post"]):
-    doc, tag, text, line = ttl = yattag.Doc().ttl()
-
-    with base_page(*ttl):
-        header(*ttl)
-
-        with tag("main", klass="main"):
-            with tag("section", klass="main__post_list"):
-                for post in posts:
-                    with tag("article", klass="main__post"):
-                        with tag("a", href=post.url):
-                            with tag("h3", klass="main__post__title"):
-                                doc.asis(typogrify(post.title))
-                        with tag("small", klass="main__post__date"):
-                            line(
-                                "time",
-                                post.date.strftime("%B %d, %Y"),
-                                datetime=post.date.isoformat(),
-                            )
-                        if post.description is not None:
-                            with tag(
-                                "p", klass="main__post__description",
-                            ):
-                                doc.asis(typogrify(post.description))
-
-    return doc.getvalue()
-
-
-def post_page(post: "Post"):
-    doc, tag, text, line = ttl = yattag.Doc().ttl()
-
-    with base_page(*ttl, title=post.title, description=post.description):
-        header(*ttl)
-
-        with tag("main", klass="main"):
-            with tag("article", klass="post"):
-                with tag("header", klass="post__header"):
-                    with tag("h2", klass="post__heading"):
-                        doc.asis(typogrify(post.title))
-                    line(
-                        "time",
-                        post.date.strftime("%B %d, %Y"),
-                        datetime=post.date.isoformat(),
-                        klass="post__heading__time",
-                    )
-                with tag("main", klass="post__main"):
-                    doc.asis(typogrify(post.html))
-        with tag("footer", klass="post__footer"):
-            doc.stag("hr")
-            text("Tell me I'm wrong: ")
-            line("a", EMAIL, href=f"mailto:{EMAIL}", klass="post__footer__email")
-
-    return doc.getvalue()
-
-
-@dataclass
-class Post:
-    title: str
-    description: Optional[str]
-    date: dt.date
-    html: str
+        buf += POST_ITEM_TEMPLATE.format(
+            url=escape(post.url),
+            title=post.title_html,
+            date_iso=post.date_iso,
+            date_display=post.date_display,
+            description=description,
+        ).encode("utf-8")
+
+    buf += HOME_CLOSE
+    buf += BASE_CLOSE
+    return buf
+
+
+def post_page(post: "Post") -> bytearray:
+    # the body is by far the biggest part of the page, so it's copied straight
+    # into the output buffer rather than formatted into a template first
+    buf = base_page_open(title=post.title, description=post.description)
+    buf += POST_OPEN_TEMPLATE.format(
+        title=post.title_html,
+        date_iso=post.date_iso,
+        date_display=post.date_display,
+    ).encode("utf-8")
+    buf += post.html_bytes
+    buf += POST_CLOSE
+    buf += BASE_CLOSE
+    return buf
 
-    @property
-    def slug(self):
-        return slugify(self.title)
 
-    @property
-    def url(self):
-        return f"/posts/{self.slug}"
+class Post:
+    __slots__ = (
+        "title",
+        "description",
+        "date",
+        "date_ordinal",
+        "html_bytes",
+        "markdown_key",
+        "source_hash",
+        "title_html",
+        "description_html",
+        "slug",
+        "url",
+        "date_display",
+        "date_iso",
+    )
 
+    def __init__(
+        self,
+        *,
+        title: str,
+        description: Optional[str],
+        date: dt.date,
+        html_bytes: bytes,
+        markdown_key: str,
+        source_hash: str,
+    ):
+        self.title = title
+        self.description = description
+        self.date = date
+        self.html_bytes = html_bytes
+        self.markdown_key = markdown_key
+        self.source_hash = source_hash
+
+        # everything the templates need is worked out once, up front
+        self.title_html = typogrify(title)
+        self.description_html = (
+            typogrify(description) if description is not None else None
+        )
+        self.slug = slugify(title)
+        if not self.slug:
+            raise ValueError(f"post {title!r} has no characters usable in its URL")
+        self.url = f"/posts/{self.slug}"
+        self.date_ordinal = date.toordinal()
+        self.date_display = date.strftime("%B %d, %Y")
+        self.date_iso = date.isoformat()
+
+
+def slugify(text: str) -> str:
+    """Turn a post title into the directory name used in its URL.
+
+    This follows the steps python-slugify 4.0.0 took, so published URLs keep
+    working. The expected values below are what that library produced:
+
+    >>> slugify("Don't panic")
+    'don-t-panic'
+    >>> slugify("World's best")
+    'world-s-best'
+    >>> slugify("World’s best")
+    'worlds-best'
+    >>> slugify("Straße und Café")
+    'strasse-und-cafe'
+    >>> slugify("Tabs — or spaces?")
+    'tabs-or-spaces'
+    >>> slugify("1,000 ways to fail")
+    '1000-ways-to-fail'
+    >>> slugify("Fish &amp; chips")
+    'fish-chips'
+    >>> slugify("it&#39;s")
+    'its'
+
+    Unlike python-slugify, non-Latin scripts are not transliterated; those
+    characters become separators, so a title written entirely in one gives an
+    empty slug.
+    """
+    # a literal apostrophe separates words, as in python-slugify; ones that only
+    # appear after unescaping or transliterating are dropped further down
+    text = unescape(QUOTE_RE.sub("-", text))
+    text = unicodedata.normalize("NFKD", text).translate(TRANSLITERATIONS)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = QUOTE_RE.sub("", text.lower())
+    text = DIGIT_COMMA_RE.sub("", text)
+    return NON_SLUG_RE.sub("-", text).strip("-")
+
+
+def content_hash(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def replace_file(path: str, data: bytes):
+    # write next to the destination and rename so readers never see a partial
+    # file, and include the pid so concurrent writers of the same path can't
+    # clobber each other's temporary file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def compressed_variants(
+    path: str, suffixes: List[str] = COMPRESSED_SUFFIXES
+) -> List[str]:
+    return [f"{path}{suffix}" for suffix in suffixes]
+
+
+def has_compressed_variants(path: str) -> bool:
+    return all(
+        map(os.path.exists, compressed_variants(path, WRITTEN_COMPRESSED_SUFFIXES))
+    )
 
-posts = []
 
-with os.scandir("posts") as it:
-    for post_file in it:
-        if not post_file.is_file() or post_file.name.startswith("."):
+def write_out(
+    path: str, data: bytes, old_hash: Optional[str] = None, precompress: bool = False
+) -> str:
+    """Write data to path unless it already has that content, and return its
+    hash for the manifest.
+
+    With precompress, compressed copies are written next to the file so the
+    web server can serve them without compressing on every request."""
+    digest = hashlib.sha256(data).hexdigest()
+    if (
+        digest == old_hash
+        and os.path.exists(path)
+        and (not precompress or has_compressed_variants(path))
+    ):
+        return digest
+
+    replace_file(path, data)
+    if precompress:
+        replace_file(f"{path}.gz", gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            replace_file(f"{path}.br", brotli.compress(data, quality=11))
+        else:
+            # an old brotli copy would be served in place of the new page
+            try:
+                os.remove(f"{path}.br")
+            except FileNotFoundError:
+                pass
+    return digest
+
+
+def load_manifest() -> Optional[Dict[str, str]]:
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def dump_manifest(manifest: Dict[str, str]) -> bytes:
+    return json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+
+
+def remove_stale(old_manifest: Dict[str, str], manifest: Dict[str, str]):
+    for rel_path in old_manifest.keys() - manifest.keys():
+        path = os.path.join("build", rel_path)
+        for stale_path in [path, *compressed_variants(path)]:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+        # clean up directories left empty, e.g. the page of a deleted post
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def copy_file(src: str, dst: str, st: os.stat_result):
+    # shutil.copyfile already uses the platform's zero-copy call (sendfile on
+    # Linux, fcopyfile on macOS); the copy is renamed into place like
+    # replace_file so an interrupted sync can't leave a truncated file behind
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    shutil.copyfile(src, tmp_path)
+    # carry the mtime over so the next sync can tell the copy is up to date
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, dst)
+
+
+def sync_tree(src: str, dst: str):
+    """Make dst a copy of src, only copying files whose size or modification
+    time differ and deleting anything in dst that isn't in src."""
+    os.makedirs(dst, exist_ok=True)
+
+    with os.scandir(src) as it:
+        src_entries = {entry.name: entry for entry in it}
+    with os.scandir(dst) as it:
+        dst_entries = {entry.name: entry for entry in it}
+
+    for name, dst_entry in list(dst_entries.items()):
+        src_entry = src_entries.get(name)
+        if src_entry is not None and src_entry.is_dir() == dst_entry.is_dir():
+            continue
+        if dst_entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(dst_entry.path)
+        else:
+            os.remove(dst_entry.path)
+        del dst_entries[name]
+
+    for name, src_entry in src_entries.items():
+        dst_path = os.path.join(dst, name)
+        if src_entry.is_dir():
+            sync_tree(src_entry.path, dst_path)
             continue
 
-        with open(post_file.path, "r") as f:
-            text = f.read()
-
-        post_raw = frontmatter.loads(text)
+        st = src_entry.stat()
+        dst_entry = dst_entries.get(name)
+        if dst_entry is not None:
+            dst_st = dst_entry.stat()
+            if (dst_st.st_size, dst_st.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                continue
+        copy_file(src_entry.path, dst_path, st)
 
-        date = post_raw["date"]
-        if isinstance(date, str):
-            date = dt.date.fromisoformat(date)
 
-        posts.append(
-            Post(
-                title=post_raw["title"],
-                description=post_raw.get("description"),
-                date=date,
-                html=mistletoe.markdown(post_raw.content).replace("&quot;", '"'),
-            )
-        )
+def markdown_cache_key(source: str) -> str:
+    return content_hash(RENDER_CACHE_VERSION, source)
 
 
-posts = list(sorted(posts, key=attrgetter("date"), reverse=True))
+def render_markdown(source: str, key: str) -> bytes:
+    """Render a post body to typogrified, UTF-8 encoded HTML, reusing the cached
+    result if this source has been rendered before."""
+    cache_path = os.path.join(CACHE_DIR, f"{key}.html")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return f.read()
 
-shutil.rmtree("build")
-os.makedirs(os.path.join("build", "posts"), exist_ok=True)
+    html = cmarkgfm.markdown_to_html_with_extensions(
+        source, options=MARKDOWN_OPTIONS, extensions=MARKDOWN_EXTENSIONS
+    )
+    # typogrify's smart quotes only see literal quote characters
+    html = typogrify(html.replace("&quot;", '"')).encode("utf-8")
+
+    replace_file(cache_path, html)
+    return html
+
+
+def prune_cache(posts: List["Post"]):
+    """Remove cached bodies and page stamps that no current post uses."""
+    keep = {f"{post.markdown_key}.html" for post in posts}
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file() and entry.name not in keep:
+                os.remove(entry.path)
+
+    slugs = {post.slug for post in posts}
+    with os.scandir(os.path.join(CACHE_DIR, "pages")) as it:
+        for entry in it:
+            if entry.name not in slugs:
+                os.remove(entry.path)
+
+
+def load_frontmatter(text: str) -> Tuple[Dict[str, Optional[str]], str]:
+    r"""Split a post into its metadata and markdown content.
+
+    The frontmatter only ever holds flat ``key: value`` pairs, so this doesn't
+    need a full YAML parser. Quoted values are unescaped the way YAML does, and
+    empty values are None, as in YAML.
+
+    >>> meta, content = load_frontmatter(
+    ...     "---\n"
+    ...     "# comments are skipped\n"
+    ...     "title: \"Hello: World's \\\"best\\\"\"\n"
+    ...     "description: 'It''s fine'\n"
+    ...     "date: 2020-01-01\n"
+    ...     "---\n"
+    ...     "Body\n"
+    ... )
+    >>> print(meta["title"])
+    Hello: World's "best"
+    >>> print(meta["description"])
+    It's fine
+    >>> meta["date"]
+    '2020-01-01'
+    >>> content
+    '\nBody'
+    >>> load_frontmatter("---\ntitle: Plain\ndescription:\n---\nBody")[0]
+    {'title': 'Plain', 'description': None}
+    >>> load_frontmatter("no frontmatter here")
+    Traceback (most recent call last):
+      ...
+    ValueError: post must start with a --- fenced frontmatter
+    """
+    parts = FRONTMATTER_BOUNDARY_RE.split(text.strip(), 2)
+    if len(parts) != 3 or parts[0].strip():
+        raise ValueError("post must start with a --- fenced frontmatter")
+    _, raw_meta, content = parts
+
+    meta = {}
+    for line in raw_meta.splitlines():
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        key, sep, value = line.partition(":")
+        if not sep:
+            raise ValueError(f"invalid frontmatter line: {line!r}")
+        value = value.strip()
+        if not value:
+            value = None
+        elif len(value) >= 2 and value[0] == value[-1] == '"':
+            # YAML's double-quoted escapes are a superset of JSON's, and the
+            # JSON ones are all a title is going to need
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValueError(f"invalid quoted value: {value}") from None
+        elif len(value) >= 2 and value[0] == value[-1] == "'":
+            value = value[1:-1].replace("''", "'")
+        meta[key.strip()] = value
+
+    return meta, content
+
+
+def read_post(path: str) -> str:
+    with open(path, "r") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return f.read()
+
+
+def parse_post(path: str, text: str) -> Post:
+    try:
+        meta, content = load_frontmatter(text)
+        for key in ("title", "date"):
+            if meta.get(key) is None:
+                raise ValueError(f"frontmatter is missing {key!r}")
+        date = dt.date.fromisoformat(meta["date"])
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from None
+
+    markdown_key = markdown_cache_key(content)
+    html_bytes = render_markdown(content, markdown_key)
+
+    try:
+        return Post(
+            title=meta["title"],
+            description=meta.get("description"),
+            date=date,
+            html_bytes=html_bytes,
+            markdown_key=markdown_key,
+            source_hash=content_hash(text),
+        )
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}") from None
+
+
+def render_and_write(
+    post: Post, old_hash: Optional[str], template_hash: str
+) -> Tuple[str, str]:
+    rel_path = os.path.join("posts", post.slug, "index.html")
+    post_path = os.path.join("build", rel_path)
+    stamp_path = os.path.join(CACHE_DIR, "pages", post.slug)
+    page_hash = content_hash(post.source_hash, template_hash)
+
+    if (
+        old_hash is not None
+        and os.path.exists(post_path)
+        and has_compressed_variants(post_path)
+        and os.path.exists(stamp_path)
+    ):
+        with open(stamp_path, "r") as f:
+            if f.read() == page_hash:
+                return rel_path, old_hash
+
+    digest = write_out(post_path, post_page(post), old_hash, precompress=True)
+    write_out(stamp_path, page_hash.encode("utf-8"))
+    return rel_path, digest
+
+
+def main():
+    os.makedirs(os.path.join(CACHE_DIR, "pages"), exist_ok=True)
+
+    with os.scandir("posts") as it:
+        paths = [
+            post_file.path
+            for post_file in it
+            if post_file.is_file() and not post_file.name.startswith(".")
+        ]
+
+    # reading is I/O bound, so it's overlapped in threads before the texts are
+    # handed to the process pool for parsing
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as tp:
+        texts = list(tp.map(read_post, paths))
+
+    with ProcessPoolExecutor() as ex:
+        posts = list(ex.map(parse_post, paths, texts))
+        posts.sort(key=attrgetter("date_ordinal"), reverse=True)
+
+        # two posts with the same slug would silently overwrite each other's page
+        posts_by_slug = {}
+        for post in posts:
+            other = posts_by_slug.setdefault(post.slug, post)
+            if other is not post:
+                raise ValueError(
+                    f"posts {other.title!r} and {post.title!r} have the same slug "
+                    f"{post.slug!r}"
+                )
+
+        prune_cache(posts)
+
+        old_manifest = load_manifest()
+        if old_manifest is None:
+            # no record of what's in the build directory, so start from scratch
+            shutil.rmtree("build", ignore_errors=True)
+            old_manifest = {}
+        manifest = {}
+
+        # post pages only depend on their own source, the stylesheet, and this
+        # script
+        with open(__file__, "r") as f:
+            template_hash = content_hash(STYLES_CSS, f.read())
+
+        # create directories up front so the workers only have to write files
+        for post in posts:
+            os.makedirs(os.path.join("build", "posts", post.slug), exist_ok=True)
+
+        # generate main page
+        manifest["index.html"] = write_out(
+            os.path.join("build", "index.html"),
+            home_page(posts),
+            old_manifest.get("index.html"),
+            precompress=True,
+        )
 
-# generate main page
-with open(os.path.join("build", "index.html"), "w") as f:
-    f.write(home_page(posts))
+        old_hashes = [
+            old_manifest.get(os.path.join("posts", post.slug, "index.html"))
+            for post in posts
+        ]
+        manifest.update(
+            ex.map(
+                partial(render_and_write, template_hash=template_hash),
+                posts,
+                old_hashes,
+            )
+        )
 
-for post in posts:
-    post_dir = os.path.join("build", "posts", post.slug)
-    os.makedirs(post_dir, exist_ok=False)
+    remove_stale(old_manifest, manifest)
+
+    if os.path.exists("static"):
+        sync_tree("static", os.path.join("build", "static"))
+    else:
+        shutil.rmtree(os.path.join("build", "static"), ignore_errors=True)
+    # the old manifest was written by dump_manifest too, so re-serialising it
+    # gives the bytes on disk and an unchanged manifest isn't rewritten
+    write_out(
+        MANIFEST_PATH,
+        dump_manifest(manifest),
+        hashlib.sha256(dump_manifest(old_manifest)).hexdigest(),
+    )
 
-    with open(os.path.join(post_dir, "index.html"), "w") as f:
-        f.write(post_page(post))
 
-if os.path.exists("static"):
-    shutil.copytree("static", os.path.join("build", "static"))
+if __name__ == "__main__":
+    main()